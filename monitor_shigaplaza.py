@@ -1,8 +1,13 @@
 # monitor_shigaplaza.py
-import os, re, hashlib, time, sqlite3, requests, smtplib, urllib.parse
+import os, re, atexit, functools, hashlib, heapq, time, threading, sqlite3, requests, smtplib, urllib.parse, zlib
+import lxml.html
+from lxml import etree
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from email.message import EmailMessage
-from bs4 import BeautifulSoup
-from datetime import datetime
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta, timezone
 
 # === 監視対象（サイトごとの抽出ルール） ===
 SITE_RULES = {
@@ -31,6 +36,9 @@ SITE_RULES = {
         "index_extract": True,   # /news の一覧から個別記事URLを抽出
         "allow_external": False,
         "title_only": True,
+        # 一覧のリンク文言にキーワードがない記事は詳細を取得しない（取得件数を減らすため）
+        # ※リンク文言が「お知らせ99」等で、キーワードが記事の h1 にしかない記事は通知されない
+        "require_anchor_keyword": True,
     },
 
     # 追加：守山商工会議所（新着更新情報）
@@ -109,6 +117,60 @@ HOST_KEYWORDS = {
     "www.kstcci.or.jp":     ["補助金", "支援金", "助成金", "講座", "セミナー"],
 }
 
+# キーワードは1本の正規表現（選択）にまとめ、本文を1回の走査で判定
+def keyword_re(words):
+    return re.compile("|".join(map(re.escape, words)))
+
+KEYWORD_RE_DEFAULT = keyword_re(KEYWORDS_DEFAULT)
+HOST_KEYWORD_RE = {host: keyword_re(kw) for host, kw in HOST_KEYWORDS.items()}
+
+# 抽出パターンは起動時に1本の正規表現へまとめてコンパイル（URLごとの判定は search 1回）
+def union_re(patterns):
+    return re.compile("|".join(f"(?:{p})" for p in patterns)) if patterns else None
+
+KSTCCI_INDEX_RE = re.compile(r"^/news(/page/\d+)?/?$")
+# 公開日/最終更新/更新日 をまとめて1回の走査で拾う
+DATE_RE = re.compile(r"(?P<label>公開日|最終更新|更新日)\s*[:：]?\s*(?P<d>[0-9]{4}[./年][01]?\d[./月][0-3]?\d)")
+
+# 同じURLを1回の実行で何度もハッシュしない（BLAKE2b-128 → 32桁のhex）
+@functools.lru_cache(maxsize=4096)
+def sha(s):
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+# SITE_RULES は起動時に1回だけ Rule へ変換（URLごとの判定は属性参照とコンパイル済み正規表現のみ）
+@dataclass(frozen=True, slots=True)
+class Rule:
+    host: str
+    list_urls: tuple
+    detail_re: re.Pattern | None
+    exclude_re: re.Pattern | None
+    keyword_re: re.Pattern
+    anchor_re: re.Pattern | None  # require_anchor_keyword のときだけ keyword_re
+    brand_new_only: bool
+    index_extract: bool
+    allow_external: bool
+    title_only: bool
+    sig: str  # 解析結果を左右する設定（キーワード・title_only・日付パターン）。変われば保存済みの結果は使わない
+
+def build_rule(host, cfg):
+    kw_re = HOST_KEYWORD_RE.get(host, KEYWORD_RE_DEFAULT)
+    title_only = cfg.get("title_only", False)
+    return Rule(
+        host=host,
+        list_urls=tuple(cfg["list_urls"]),
+        detail_re=union_re(cfg.get("detail_patterns", [])),
+        exclude_re=union_re(cfg.get("exclude_patterns", [])),
+        keyword_re=kw_re,
+        anchor_re=kw_re if cfg.get("require_anchor_keyword", False) else None,
+        brand_new_only=cfg.get("brand_new_only", False),
+        index_extract=cfg.get("index_extract", False),
+        allow_external=cfg.get("allow_external", False),
+        title_only=title_only,
+        sig=sha(f"{kw_re.pattern}\0{title_only}\0{DATE_RE.pattern}"),
+    )
+
+RULES = {host: build_rule(host, cfg) for host, cfg in SITE_RULES.items()}
+
 DB = "shigaplaza.db"
 
 SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
@@ -120,142 +182,516 @@ RECIPIENT_EMAIL = os.getenv("RECIPIENT_EMAIL", "57180928miwa@gmail.com")
 # ★エラー通知トグル：1/true/yes でメール通知（デフォルトは送らない）
 ERROR_NOTIFY = os.getenv("ERROR_NOTIFY", "0").lower() in ("1", "true", "yes")
 
+# 詳細ページの同時取得数（1ホストあたり）
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "4"))
+# 同一ホストへのリクエスト開始間隔（秒）。別ホストどうしは待ち合わせない（ホストは並列に巡回）
+HOST_INTERVAL = float(os.getenv("HOST_INTERVAL", "1.5"))
+# 1ページあたりの読み込み上限（バイト）。超えた分は読まずに切り捨てる
+MAX_BYTES = int(os.getenv("MAX_BYTES", str(1 << 20)))
+
 UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X) AppleWebKit/537.36 (KHTML, like Gecko) MonitorBot/1.11"
 
+# HTTPはセッション共有（ホストごとに keep-alive で接続を再利用）
+SESSION = requests.Session()
+# Accept-Encoding は requests の既定のまま（brotli が入っていれば br も名乗る）
+SESSION.headers.update({
+    "User-Agent": UA,
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "ja,en;q=0.5",
+})
+# 再試行は urllib3 に任せず limited_get() で行う（再試行も HostLimiter の間隔に従わせるため）
+_ADAPTER = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+
+class HostLimiter:
+    # ホストごとに「次に投げてよい時刻」を持つ。スレッドから呼ばれるのでホスト単位でロック
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_ok = {}
+        self.locks = {}
+        self.guard = threading.Lock()
+
+    def wait(self, host):
+        with self.guard:
+            lock = self.locks.setdefault(host, threading.Lock())
+        with lock:
+            now = time.monotonic()
+            t = self.next_ok.get(host, 0.0)
+            if t > now:
+                time.sleep(t - now)
+                now = t
+            self.next_ok[host] = now + self.interval
+
+    def defer(self, host, seconds):
+        # Retry-After を受けたホストは、他スレッドの分も含めて指定秒数あける
+        with self.guard:
+            lock = self.locks.setdefault(host, threading.Lock())
+        with lock:
+            self.next_ok[host] = max(self.next_ok.get(host, 0.0), time.monotonic() + seconds)
+
+# Retry-After に従って待つ上限（秒）。30分おきの実行を1ホストで止めない
+MAX_RETRY_AFTER = 60.0
+
+def retry_after(r):
+    # 秒数 または HTTP日付。読めなければ 0
+    v = r.headers.get("Retry-After", "").strip()
+    if v.isdigit():
+        return float(v)
+    try:
+        return max(0.0, (parsedate_to_datetime(v) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0.0
+
+LIMITER = HostLimiter(HOST_INTERVAL)
+
+# 一時的な 429/5xx・接続エラーの再試行回数と、再試行前の待ち（0.5, 1, 2 秒）
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+def limited_get(url, headers):
+    # 同一ホストへのリクエストは再試行も含めてすべて LIMITER を通す
+    # 使い切ったら最後の応答を返す（呼び出し側で raise_for_status）
+    host = host_of(url)
+    for attempt in range(RETRIES + 1):
+        last = attempt == RETRIES
+        LIMITER.wait(host)
+        try:
+            r = SESSION.get(url, timeout=25, headers=headers, stream=True)
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+            LIMITER.defer(host, RETRY_BACKOFF * 2 ** attempt)
+            continue
+        if last or r.status_code not in RETRY_STATUS:
+            return r
+        wait = max(RETRY_BACKOFF * 2 ** attempt, retry_after(r))
+        if wait > MAX_RETRY_AFTER:
+            # 長い Retry-After（メンテナンス中など）は再試行せずに返す
+            return r
+        r.close()
+        LIMITER.defer(host, wait)
+
+CONN = None
+CUR = None
+ITEM_COLS = ()
+INSERT_SQL = ""
+
+# 既存ID/URLは起動時に一括ロードし、判定はメモリ上で行う
+SEEN_IDS = set()
+SEEN_URLS = set()
+SEEDED_HOSTS = set()
+
+# 条件付きGET用：url -> (etag, last_modified, encoding, zlib圧縮した本文)
+# 本文は一覧ページだけ残す（詳細ページは 304 なら DETAILS の解析結果を使うので None）
+HTTP_CACHE = {}
+HTTP_CACHE_DIRTY = set()
+# この実行で取得しようとしたURL（これ以外のキャッシュ行は prune_caches() で削除）
+FETCHED = set()
+# 詳細ページの解析結果：url -> (sig, body_sha, title, published, updated, hit, volatile, saved_at)。本文が同じなら解析せずこれを返す
+# volatile=1 は「前回の取得で本文だけが変わった」印。続けて本文だけ変わるページは、saved_at から
+# VOLATILE_REWRITE 経つまで body_sha を書き直さない（毎回変わるページでDBを毎回更新しないため）
+DETAILS = {}
+DETAILS_DIRTY = set()
+VOLATILE_REWRITE = timedelta(hours=24)
+# 1回の実行内のメモ（初回サンプルと通常運転で同じ一覧・詳細を取り直さない）
+LIST_MEMO = {}
+DETAIL_MEMO = {}
+
 def init_db():
-    con = sqlite3.connect(DB)
-    con.execute("""CREATE TABLE IF NOT EXISTS items(
+    global CONN, CUR, ITEM_COLS, INSERT_SQL
+    # 1回の実行につき接続は1本（都度 connect/commit/close しない）
+    CONN = sqlite3.connect(DB, isolation_level=None)
+    atexit.register(CONN.close)
+    CONN.execute("PRAGMA journal_mode=WAL")
+    CONN.execute("PRAGMA synchronous=NORMAL")
+    CONN.execute("PRAGMA temp_store=MEMORY")
+    CONN.execute("PRAGMA cache_size=-20000")
+    CONN.execute("PRAGMA mmap_size=268435456")
+    CONN.execute("""CREATE TABLE IF NOT EXISTS items(
       id TEXT PRIMARY KEY,
       url TEXT, title TEXT, published TEXT, updated TEXT, src TEXT, created_at TEXT
     )""")
-    con.execute("""CREATE TABLE IF NOT EXISTS samples(
+    CONN.execute("""CREATE TABLE IF NOT EXISTS samples(
       host TEXT PRIMARY KEY,
       sent_at TEXT
     )""")
-    con.commit(); con.close()
+    CONN.execute("""CREATE TABLE IF NOT EXISTS http_cache(
+      url TEXT PRIMARY KEY,
+      etag TEXT, last_modified TEXT, encoding TEXT, body BLOB, fetched_at TEXT
+    )""")
+    CONN.execute("""CREATE TABLE IF NOT EXISTS details(
+      url TEXT PRIMARY KEY,
+      sig TEXT, body_sha TEXT, title TEXT, published TEXT, updated TEXT, hit INTEGER
+    )""")
+    detail_cols = get_table_columns("details")
+    if "body_sha" not in detail_cols:
+        CONN.execute("ALTER TABLE details ADD COLUMN body_sha TEXT")
+    if "volatile" not in detail_cols:
+        CONN.execute("ALTER TABLE details ADD COLUMN volatile INTEGER NOT NULL DEFAULT 0")
+    if "saved_at" not in detail_cols:
+        CONN.execute("ALTER TABLE details ADD COLUMN saved_at TEXT")
+    cols = get_table_columns("items")
+    ITEM_COLS = tuple(c for c in ("id","url","title","published","updated","src","created_at","host") if c in cols)
+    INSERT_SQL = f"INSERT OR IGNORE INTO items ({','.join(ITEM_COLS)}) VALUES ({','.join(['?'] * len(ITEM_COLS))})"
+    CONN.execute("CREATE INDEX IF NOT EXISTS ix_items_url ON items(url)")
+    CONN.execute("CREATE INDEX IF NOT EXISTS ix_items_src ON items(src)")
+    migrate_item_ids()
+    for item_id, url in CONN.execute("SELECT id, url FROM items"):
+        SEEN_IDS.add(item_id)
+        SEEN_URLS.add(url)
+    for url, etag, lm, enc, body in CONN.execute("SELECT url, etag, last_modified, encoding, body FROM http_cache"):
+        HTTP_CACHE[url] = (etag, lm, enc, body)
+    for url, *d in CONN.execute("SELECT url, sig, body_sha, title, published, updated, hit, volatile, saved_at FROM details"):
+        DETAILS[url] = tuple(d)
+    # 実行中のクエリはこのカーソル1本を使い回す（準備済みステートメントもキャッシュされる）
+    CUR = CONN.cursor()
 
 def get_table_columns(table: str):
-    con = sqlite3.connect(DB); cur = con.cursor()
-    cur.execute(f"PRAGMA table_info({table})")
-    cols = [r[1] for r in cur.fetchall()]
-    con.close()
-    return cols
-
-def sha(s): 
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
-
-def get_soup(url):
-    r = requests.get(url, timeout=25, headers={"User-Agent": UA})
-    r.raise_for_status()
-    return BeautifulSoup(r.text, "lxml")
+    return [r[1] for r in CONN.execute(f"PRAGMA table_info({table})")]
+
+def migrate_item_ids():
+    # 旧ID（sha256, 64桁）を同じ元文字列の BLAKE2b ID に付け替える（既存記事を新着として再通知しない）
+    # 元文字列は url（brand_new_only）か url|更新日or公開日。どちらとも一致しない行はそのまま残す
+    renames = []
+    for item_id, url, published, updated in CONN.execute("SELECT id, url, published, updated FROM items WHERE length(id) = 64"):
+        for basis in (url, f"{url}|{updated or published}"):
+            if hashlib.sha256(basis.encode("utf-8"), usedforsecurity=False).hexdigest() == item_id:
+                renames.append((sha(basis), item_id))
+                break
+    if not renames:
+        return
+    CONN.execute("BEGIN")
+    try:
+        # 付け替え先のIDが既にあれば同じ記事なので置き換える
+        CONN.executemany("UPDATE OR REPLACE items SET id=? WHERE id=?", renames)
+        CONN.execute("COMMIT")
+    except Exception:
+        CONN.execute("ROLLBACK")
+        raise
+    print(f"[INFO] migrated {len(renames)} item ids to BLAKE2b")
+
+def cached_get(url, keep_body=True):
+    # ETag / Last-Modified があれば条件付きGETし、304なら保存済みの本文を返す
+    # keep_body=False（詳細ページ）は本文を保存せず、304 のときは本文 None を返す
+    FETCHED.add(url)
+    cached = HTTP_CACHE.get(url)
+    headers = {}
+    # 本文が要るのに保存していない行は条件付きにしない
+    if cached and (cached[3] is not None or not keep_body):
+        etag, lm = cached[0], cached[1]
+        if etag:
+            headers["If-None-Match"] = etag
+        if lm:
+            headers["If-Modified-Since"] = lm
+    with limited_get(url, headers) as r:
+        if r.status_code == 304 and headers:
+            if keep_body:
+                return zlib.decompress(cached[3]), cached[2]
+            if cached[3] is not None:
+                # 本文を保存していた旧い行は検証子だけにする
+                HTTP_CACHE[url] = (*cached[:3], None)
+                HTTP_CACHE_DIRTY.add(url)
+            return None, cached[2]
+        if r.status_code in (429, 503):
+            # 再試行を使い切っても混んでいるなら、そのホストへの次のリクエストを遅らせる
+            LIMITER.defer(host_of(url), min(retry_after(r), MAX_RETRY_AFTER))
+        r.raise_for_status()
+        ctype = r.headers.get("Content-Type", "").lower()
+        # bytesのまま渡す（文字コードはヘッダ指定があればそれ、なければ meta から判定）
+        enc = r.encoding if "charset" in ctype else None
+        # HTML以外（PDF等）は本文を読まない（空のページとして扱う）
+        body = read_capped(r) if not ctype or "html" in ctype else b""
+    etag, lm = r.headers.get("ETag"), r.headers.get("Last-Modified")
+    if etag or lm:
+        entry = (etag, lm, enc, zlib.compress(body) if keep_body else None)
+        # 条件付きGETを無視して毎回200を返すサーバでも、中身が同じなら書き直さない
+        if entry != cached:
+            HTTP_CACHE[url] = entry
+            HTTP_CACHE_DIRTY.add(url)
+    elif cached:
+        # 検証子が付かなくなったURLはキャッシュから外す
+        del HTTP_CACHE[url]
+        HTTP_CACHE_DIRTY.add(url)
+    return body, enc
+
+def read_capped(r):
+    # 展開後の本文を MAX_BYTES まで読む（巨大なページを丸ごとメモリに載せない）
+    chunks, n = [], 0
+    for chunk in r.iter_content(64 * 1024):
+        chunks.append(chunk)
+        n += len(chunk)
+        if n >= MAX_BYTES:
+            break
+    return b"".join(chunks)[:MAX_BYTES]
+
+def prune_caches(hosts):
+    # 指定ホストのうち、この実行で取得しなかったURL（一覧から消えた・既知で取得しない記事）のキャッシュを捨てる
+    # DBに全文を持ち続けないため。一覧の取得に失敗したホストは渡さない（一時的に見えなかっただけの行を消さない）
+    for cache, dirty in ((HTTP_CACHE, HTTP_CACHE_DIRTY), (DETAILS, DETAILS_DIRTY)):
+        for u in [u for u in cache if u not in FETCHED and host_of(u) in hosts]:
+            del cache[u]
+            dirty.add(u)
+
+def save_http_cache():
+    # 中身が変わった分・解析し直した分・削除した分だけ書き戻す（変化のない実行ではDBを変更しない）
+    if not (HTTP_CACHE_DIRTY or DETAILS_DIRTY):
+        return
+    now = datetime.utcnow().isoformat()+"Z"
+    rows = [(u, *HTTP_CACHE[u], now) for u in HTTP_CACHE_DIRTY if u in HTTP_CACHE]
+    gone = [(u,) for u in HTTP_CACHE_DIRTY if u not in HTTP_CACHE]
+    details = [(u, *DETAILS[u]) for u in DETAILS_DIRTY if u in DETAILS]
+    gone_details = [(u,) for u in DETAILS_DIRTY if u not in DETAILS]
+    CUR.execute("BEGIN")
+    try:
+        CUR.executemany("INSERT OR REPLACE INTO http_cache(url, etag, last_modified, encoding, body, fetched_at) VALUES (?,?,?,?,?,?)", rows)
+        CUR.executemany("DELETE FROM http_cache WHERE url=?", gone)
+        CUR.executemany("INSERT OR REPLACE INTO details(url, sig, body_sha, title, published, updated, hit, volatile, saved_at) VALUES (?,?,?,?,?,?,?,?,?)", details)
+        CUR.executemany("DELETE FROM details WHERE url=?", gone_details)
+        CUR.execute("COMMIT")
+    except Exception:
+        CUR.execute("ROLLBACK")
+        raise
+    HTTP_CACHE_DIRTY.clear()
+    DETAILS_DIRTY.clear()
+    # 本文の削除などで空きページが溜まったらファイルを詰める（state ブランチに載る DB を小さく保つ）
+    if CONN.execute("PRAGMA freelist_count").fetchone()[0] > 64:
+        CONN.execute("VACUUM")
+
+def tree_of(body, enc):
+    parser = lxml.html.HTMLParser(encoding=enc) if enc else None
+    try:
+        return lxml.html.document_fromstring(body, parser=parser)
+    except etree.ParserError:
+        # 要素のない本文（空・コメントだけ・XML宣言だけ等）は lxml がエラーにするので、タイトルも本文もないページとして扱う
+        return lxml.html.document_fromstring("<html></html>")
+
+def get_tree(url):
+    body, enc = cached_get(url)
+    return tree_of(body, enc)
+
+# XPath は起動時に1回だけコンパイルして全ページで使い回す
+ANCHORS = etree.XPath("//a[@href]")
+FIRST_H1 = etree.XPath("(//h1)[1]")
+FIRST_TITLE = etree.XPath("(//title)[1]")
+# script/style/template を除いたテキストノード（BeautifulSoup の get_text と同じ対象）
+TEXT_NODES = etree.XPath("//text()[not(ancestor::script or ancestor::style or ancestor::template)]")
+
+def text_of(el):
+    # BeautifulSoup の get_text(strip=True) 相当
+    return "".join(t.strip() for t in el.itertext())
+
+# --- lxml への依存はここから下の取り出し関数に集約 ---
+def extract_title(tree):
+    # 最初の h1、なければ title。どちらもなければ None
+    t = FIRST_H1(tree) or FIRST_TITLE(tree)
+    return text_of(t[0]) if t else None
+
+def extract_strings(tree):
+    return TEXT_NODES(tree)
+
+def join_strings(strings):
+    # BeautifulSoup の get_text(" ", strip=True) 相当
+    return " ".join(x for x in (t.strip() for t in strings) if x)
+
+# 同じURLを何度も parse しない（host_of/path_of/リンク抽出/登録で共有）
+@functools.lru_cache(maxsize=8192)
+def _parse(url):
+    return urllib.parse.urlparse(url)
 
 def host_of(url):
-    return urllib.parse.urlparse(url).netloc
+    return _parse(url).netloc
 
-def same_host(url, host):
-    return host_of(url) == host
+def iter_links(tree, base):
+    # (絶対URL, parse 結果, <a>要素) を返す。URLの結合・parse は1回だけ（mailto:/tel:/# 付きは除外）
+    for a in ANCHORS(tree):
+        href = a.get("href").strip()
+        if not href or href[:7].lower() == "mailto:" or href[:4].lower() == "tel:":
+            continue
+        u = urllib.parse.urljoin(base, href)
+        if "#" in u:
+            continue
+        yield u, _parse(u), a
 
-def norm_url(base, href):
-    href = (href or "").strip()
-    if not href:
-        return ""
-    u = urllib.parse.urljoin(base, href)
-    if u.startswith("mailto:") or u.startswith("tel:") or "#" in u:
-        return ""
-    return u
+def picked_with_text(links):
+    # [(url, アンカーテキスト)]。同じURLへの複数リンクはテキストを空白でつなぐ
+    # 上限200件はURL順の先頭から（全件ソートせず O(N log 200) で取り出す）
+    return [(u, " ".join(filter(None, map(text_of, links[u])))) for u in heapq.nsmallest(200, links)]
 
 def path_of(url):
-    return urllib.parse.urlparse(url).path or "/"
+    return _parse(url).path or "/"
 
-def any_match(patterns, path):
-    return any(re.search(p, path) for p in patterns)
+def pick_articles_from_list(list_url, rule, log):
+    if list_url not in LIST_MEMO:
+        LIST_MEMO[list_url] = extract_articles(list_url, rule, log)
+    return LIST_MEMO[list_url]
 
-def pick_articles_from_list(list_url, rule):
+def extract_articles(list_url, rule, log):
     host = host_of(list_url)
-    soup = get_soup(list_url)
-    links = set()
+    tree = get_tree(list_url)
+    links = {}
+    detail_re, exclude_re = rule.detail_re, rule.exclude_re
 
     # 草津商工会議所：/news 一覧から個別記事URL抽出
-    if rule.get("index_extract", False) and host == "www.kstcci.or.jp":
+    if rule.index_extract and host == "www.kstcci.or.jp":
         p = path_of(list_url)
-        if re.match(r"^/news(/page/\d+)?/?$", p):
-            for a in soup.select("a[href]"):
-                u = norm_url(list_url, a.get("href"))
-                if not u or not same_host(u, host):
+        if KSTCCI_INDEX_RE.match(p):
+            for u, parsed, a in iter_links(tree, list_url):
+                if parsed.netloc != host:
                     continue
-                path = path_of(u).lower()
-                if any_match(rule["detail_patterns"], path):
-                    links.add(u)
-            picked = sorted(links)
-            print(f"[DEBUG] kstcci index-extract: picked {len(picked)} links from {list_url}")
-            return picked[:200]
+                path = (parsed.path or "/").lower()
+                if detail_re and detail_re.search(path):
+                    links.setdefault(u, []).append(a)
+            log.append((None, f"[DEBUG] kstcci index-extract: picked {len(links)} links from {list_url}"))
+            return picked_with_text(links)
 
     # 汎用：同一ホスト & detail_patterns に合致
-    for a in soup.select("a[href]"):
-        u = norm_url(list_url, a.get("href"))
-        if not u:
+    for u, parsed, a in iter_links(tree, list_url):
+        if not rule.allow_external and parsed.netloc != host:
             continue
-        if not rule.get("allow_external", False) and not same_host(u, host):
+        path = (parsed.path or "/").lower()
+        if exclude_re and exclude_re.search(path):
             continue
-        path = path_of(u).lower()
-        if rule.get("exclude_patterns") and any_match(rule["exclude_patterns"], path):
-            continue
-        if any_match(rule["detail_patterns"], path):
-            links.add(u)
-
-    picked = sorted(links)
-    print(f"[DEBUG] {host}: picked {len(picked)} links from {list_url}")
-    return picked[:200]
+        if detail_re and detail_re.search(path):
+            links.setdefault(u, []).append(a)
+
+    log.append((None, f"[DEBUG] {host}: picked {len(links)} links from {list_url}"))
+    return picked_with_text(links)
+
+def body_sha(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def saved_recently(saved_at, now):
+    return bool(saved_at) and now - datetime.fromisoformat(saved_at.rstrip("Z")) < VOLATILE_REWRITE
+
+def remember_detail(sig, h, d):
+    result = (d["title"], d["published"], d["updated"], int(d["hit"]))
+    saved = DETAILS.get(d["url"])
+    now = datetime.utcnow()
+    volatile = 0
+    if saved and saved[1] and saved[0] == sig and saved[2:6] == result:
+        # 解析結果は同じで本文だけが変わった
+        if saved[6] and saved_recently(saved[7], now):
+            # 前回も本文だけ変わっていた＝取得のたびに変わるページかもしれない。間隔をあけて書き直す
+            # （書き直した後に本文が一致すれば mark_stable() で印が外れる）
+            return
+        volatile = 1
+    v = (sig, h, *result, volatile)
+    if saved is None or saved[:7] != v:
+        DETAILS[d["url"]] = (*v, now.isoformat()+"Z")
+        DETAILS_DIRTY.add(d["url"])
+
+def mark_stable(url):
+    # 本文が前回と一致した → 毎回変わるページではなかったので印を外す
+    saved = DETAILS[url]
+    if saved[6]:
+        DETAILS[url] = (*saved[:6], 0, saved[7])
+        DETAILS_DIRTY.add(url)
+
+def saved_detail(url):
+    title, published, updated, hit = DETAILS[url][2:6]
+    return dict(url=url, title=title, published=published, updated=updated, hit=bool(hit))
 
 def parse_detail(url, rule):
-    s = get_soup(url)
-    t = s.select_one("h1")
-    title = (t.get_text(strip=True) if t else (s.title.get_text(strip=True) if s.title else url))
-    text = s.get_text(" ", strip=True)
+    if url not in DETAIL_MEMO:
+        DETAIL_MEMO[url] = fetch_detail(url, rule)
+    return DETAIL_MEMO[url]
+
+def fetch_detail(url, rule):
+    body, enc = cached_get(url, keep_body=False)
+    saved = DETAILS.get(url)
+    if body is None:
+        # 304：前回の解析結果をそのまま使う
+        if saved and saved[0] == rule.sig:
+            mark_stable(url)
+            return saved_detail(url)
+        # 設定が変わった等で使える結果がなければ、検証子を捨てて本文を取り直す
+        del HTTP_CACHE[url]
+        HTTP_CACHE_DIRTY.add(url)
+        body, enc = cached_get(url, keep_body=False)
+    h = body_sha(body)
+    if saved and saved[0] == rule.sig and saved[1] == h:
+        # 本文が前回と同じなら解析・正規表現は省略
+        mark_stable(url)
+        return saved_detail(url)
+    d = analyze_detail(url, tree_of(body, enc), rule)
+    remember_detail(rule.sig, h, d)
+    return d
+
+def analyze_detail(url, tree, rule):
+    title = extract_title(tree)
+    if title is None:
+        title = url
+
+    # ホスト別キーワード
+    kw_re = rule.keyword_re
+
+    # タイトルのみ/本文も対象（短いタイトルを先に見て、外れたときだけ本文を走査）
+    hit = kw_re.search(title) is not None
+    strings = None
+    if not hit and not rule.title_only:
+        strings = extract_strings(tree)
+        # ノード単位で走査し、最初にヒットした時点で打ち切る
+        hit = any(kw_re.search(x) for x in strings)
+    if not hit:
+        # ヒットしなければ日付は使われないので本文の連結も省略
+        return dict(url=url, title=title, published="", updated="", hit=False)
+
+    if strings is None:
+        strings = extract_strings(tree)
+    # 本文の連結は1ページにつき1回だけ（日付抽出はこの文字列を使う）
+    published, updated = extract_dates(join_strings(strings))
+
+    return dict(url=url, title=title, published=published, updated=updated, hit=hit)
+
+def extract_dates(text):
+    # ラベルごとに最初に出てきた日付を採用 → (公開日, 最終更新 or 更新日)
+    dates = {}
+    for m in DATE_RE.finditer(text):
+        dates.setdefault(m.group("label"), m.group("d"))
 
     def find_date(label):
-        m = re.search(label + r"\s*[:：]?\s*([0-9]{4}[./年][01]?\d[./月][0-3]?\d)", text)
-        if m:
-            raw = m.group(1).replace("年", ".").replace("月", ".").replace("日", "")
+        raw = dates.get(label)
+        if raw:
+            raw = raw.replace("年", ".").replace("月", ".").replace("日", "")
             return raw.replace("/", ".")
         return ""
 
-    published = find_date("公開日")
-    updated   = find_date("最終更新") or find_date("更新日")
-
-    # ホスト別キーワード
-    kw = HOST_KEYWORDS.get(host_of(url), KEYWORDS_DEFAULT)
-
-    # タイトルのみ/本文も対象
-    if rule.get("title_only", False):
-        hit = any(k in title for k in kw)
-    else:
-        hit = any(k in title or k in text for k in kw)
+    return find_date("公開日"), find_date("最終更新") or find_date("更新日")
 
-    return dict(url=url, title=title, published=published, updated=updated, hit=hit)
+def iter_details(urls, rule):
+    # 詳細ページは並列に取得・解析し、(url, 結果, 例外) を urls の順で返す（DB/メールは呼び出し側で逐次）
+    # 1件の失敗（リンク切れの404など）で残りのURLを止めない
+    def one(u):
+        try:
+            return u, parse_detail(u, rule), None
+        except Exception as e:
+            return u, None, e
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        yield from ex.map(one, urls)
 
 def make_item_id(url, updated, published, rule):
-    if rule.get("brand_new_only", False):
+    if rule.brand_new_only:
         return sha(url)
     basis = url + "|" + (updated or published)
     return sha(basis or url)
 
+def remember(item_id, url, src):
+    SEEN_IDS.add(item_id)
+    SEEN_URLS.add(url)
+    # host_seeded() は https://{host}/ 始まりの url/src で判定
+    for u in (url, src):
+        if u and u.startswith("https://"):
+            SEEDED_HOSTS.add(host_of(u))
+
 def known(item_id):
-    con = sqlite3.connect(DB); cur = con.cursor()
-    cur.execute("SELECT 1 FROM items WHERE id=?", (item_id,))
-    ok = cur.fetchone() is not None
-    con.close()
-    return ok
+    return item_id in SEEN_IDS
 
 def known_by_url(url):
-    con = sqlite3.connect(DB); cur = con.cursor()
-    cur.execute("SELECT 1 FROM items WHERE url=?", (url,))
-    ok = cur.fetchone() is not None
-    con.close()
-    return ok
+    return url in SEEN_URLS
 
-def save(item, src):
-    cols = get_table_columns("items")
+def item_row(item, src):
     values = {
         "id": item["id"],
         "url": item["url"],
@@ -265,34 +701,80 @@ def save(item, src):
         "src": src,
         "created_at": datetime.utcnow().isoformat()+"Z",
         # 旧スキーマ互換：host列がある場合だけ投入
-        "host": urllib.parse.urlparse(item["url"]).netloc
+        "host": host_of(item["url"])
     }
-    use_cols = []
-    use_vals = []
-    for c in ("id","url","title","published","updated","src","created_at","host"):
-        if c in cols:
-            use_cols.append(c)
-            use_vals.append(values[c])
-    placeholders = ",".join(["?"] * len(use_cols))
-    col_list = ",".join(use_cols)
-    sql = f"INSERT OR IGNORE INTO items ({col_list}) VALUES ({placeholders})"
-    con = sqlite3.connect(DB)
-    con.execute(sql, tuple(use_vals))
-    con.commit(); con.close()
+    return tuple(values[c] for c in ITEM_COLS)
 
-def send_mail(subject: str, body: str):
-    if not (SMTP_SENDER and SMTP_PASSWORD):
-        print("SMTP env not set; skip email")
+# 登録待ち（items / samples）。flush_pending() で1トランザクションにまとめて書き込む
+PENDING = []
+PENDING_SAMPLES = []
+
+def stage(item, src):
+    # 登録待ちに積む（既知判定にはこの時点で反映）
+    PENDING.append(item_row(item, src))
+    remember(item["id"], item["url"], src)
+
+def flush_pending():
+    if not (PENDING or PENDING_SAMPLES):
         return
-    msg = EmailMessage()
-    msg["Subject"] = subject
-    msg["From"] = f"サイト監視 <{SMTP_SENDER}>"
-    msg["To"] = RECIPIENT_EMAIL
-    msg.set_content(body)
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20) as s:
+    # まとめて1トランザクション（fsyncは1回）
+    CUR.execute("BEGIN")
+    try:
+        CUR.executemany(INSERT_SQL, PENDING)
+        CUR.executemany("INSERT OR REPLACE INTO samples(host, sent_at) VALUES(?, ?)", PENDING_SAMPLES)
+        CUR.execute("COMMIT")
+    except Exception:
+        CUR.execute("ROLLBACK")
+        raise
+    PENDING.clear()
+    PENDING_SAMPLES.clear()
+
+class SMTPNotifier:
+    # 1回の実行で SMTP 接続（EHLO/STARTTLS/LOGIN）を使い回す。接続は最初の送信時に行う
+    def __init__(self):
+        self.smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except smtplib.SMTPException:
+                pass
+            self.smtp = None
+
+    def connect(self):
+        s = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20)
         s.ehlo(); s.starttls(); s.ehlo()
         s.login(SMTP_SENDER, SMTP_PASSWORD)
-        s.send_message(msg)
+        self.smtp = s
+
+    def __call__(self, subject: str, body: str):
+        if not (SMTP_SENDER and SMTP_PASSWORD):
+            print("SMTP env not set; skip email")
+            return
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        msg["From"] = f"サイト監視 <{SMTP_SENDER}>"
+        msg["To"] = RECIPIENT_EMAIL
+        msg.set_content(body)
+        if self.smtp is None:
+            self.connect()
+        try:
+            self.smtp.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # サーバ側で切られていたら1回だけ張り直す
+            self.connect()
+            self.smtp.send_message(msg)
+
+def send_mail(subject: str, body: str):
+    with SMTPNotifier() as notify:
+        notify(subject, body)
 
 def notify_error(title: str, body: str):
     if ERROR_NOTIFY:
@@ -301,24 +783,24 @@ def notify_error(title: str, body: str):
         print(f"[WARN] {title}\n{body}")
 
 def host_seeded(host: str) -> bool:
-    prefix = f"https://{host}/"
-    con = sqlite3.connect(DB); cur = con.cursor()
-    cur.execute("SELECT 1 FROM items WHERE url LIKE ? OR src LIKE ? LIMIT 1", (prefix + "%", prefix + "%"))
-    ok = cur.fetchone() is not None
-    con.close()
-    return ok
+    if host in SEEDED_HOSTS:
+        return True
+    # url/src が https://{host}/ で始まる行があるか（索引の範囲検索。'0' は '/' の次の文字）
+    lo, hi = f"https://{host}/", f"https://{host}0"
+    cur = CUR.execute(
+        "SELECT EXISTS(SELECT 1 FROM items WHERE url >= ? AND url < ?)"
+        " OR EXISTS(SELECT 1 FROM items WHERE src >= ? AND src < ?)",
+        (lo, hi, lo, hi))
+    if cur.fetchone()[0]:
+        SEEDED_HOSTS.add(host)
+        return True
+    return False
 
 def sample_sent(host: str) -> bool:
-    con = sqlite3.connect(DB); cur = con.cursor()
-    cur.execute("SELECT 1 FROM samples WHERE host=?", (host,))
-    ok = cur.fetchone() is not None
-    con.close()
-    return ok
+    return CUR.execute("SELECT 1 FROM samples WHERE host=?", (host,)).fetchone() is not None
 
 def mark_sample_sent(host: str):
-    con = sqlite3.connect(DB)
-    con.execute("INSERT OR REPLACE INTO samples(host, sent_at) VALUES(?, ?)", (host, datetime.utcnow().isoformat()+"Z"))
-    con.commit(); con.close()
+    PENDING_SAMPLES.append((host, datetime.utcnow().isoformat()+"Z"))
 
 def date_key(published: str, updated: str):
     s = (updated or published or "").replace("/", ".")
@@ -328,26 +810,58 @@ def date_key(published: str, updated: str):
     except Exception:
         return (0, 0, 0)
 
-def pick_latest_matching(host: str, rule: dict):
-    candidates = []
-    for src in rule["list_urls"]:
+def report(log):
+    # ワーカーで集めた出力 (None, 行) とエラー通知 (件名, 本文) をメインスレッドで順に出す
+    for title, body in log:
+        if title is None:
+            print(body)
+        else:
+            notify_error(title, body)
+
+def collect_links(host: str, rule: Rule, error_title: str, log: list):
+    # 一覧ページをすべて取得し、詳細URL -> 最初に出てきた一覧URL（出所）にまとめる
+    sources = {}
+    # require_anchor_keyword: 一覧のリンク文言にキーワードがない記事は詳細を取得しない
+    anchor_re = rule.anchor_re
+    for src in rule.list_urls:
         try:
-            for url in pick_articles_from_list(src, rule):
-                d = parse_detail(url, rule)
-                if d["hit"]:
-                    candidates.append((src, d))
-            time.sleep(1)
+            for url, anchor_text in pick_articles_from_list(src, rule, log):
+                if anchor_re is not None and not anchor_re.search(anchor_text):
+                    continue
+                sources.setdefault(url, src)
         except Exception as e:
-            notify_error("【監視失敗】一覧取得エラー", f"HOST: {host}\nSRC: {src}\nError: {e}")
+            log.append((error_title, f"HOST: {host}\nSRC: {src}\nError: {e}"))
+    return sources
+
+def crawl(host: str, rule: Rule, error_title: str, skip_known: bool = False):
+    # 1ホスト分の一覧・詳細を取得して解析まで行う（DB/メール/出力は触らないのでホスト単位で並列に呼べる）
+    # 出力・エラー通知は log に積んで返し、呼び出し側が report() でホスト順に出す
+    log = []
+    sources = collect_links(host, rule, error_title, log)
+    if skip_known and rule.brand_new_only:
+        # brand_new_only は URL だけで既知か決まる → 既知URLは詳細を取得しない
+        sources = {u: src for u, src in sources.items() if not (known_by_url(u) or known(make_item_id(u, "", "", rule)))}
+    details, failed = [], []
+    for url, d, e in iter_details(sources, rule):
+        if e is None:
+            details.append(d)
+        else:
+            failed.append(f"URL: {url}\nError: {e}")
+    if failed:
+        # 失敗した詳細URLはホストごとに1通にまとめる
+        log.append((error_title, f"HOST: {host}\n" + "\n".join(failed)))
+    return sources, details, log
+
+def pick_latest_matching(host: str, rule: Rule):
+    sources, details, log = crawl(host, rule, "【監視失敗】一覧取得エラー")
+    report(log)
+    candidates = [(sources[d["url"]], d) for d in details if d["hit"]]
     if not candidates:
         return None
     candidates.sort(key=lambda t: (date_key(t[1]["published"], t[1]["updated"]), t[1]["url"]), reverse=True)
     return candidates[0]
 
-def main():
-    print(f"[DEBUG] FORCE_MAIL={os.getenv('FORCE_MAIL')!r}  FORCE_SAMPLE={os.getenv('FORCE_SAMPLE')!r}  ERROR_NOTIFY={ERROR_NOTIFY}")
-    init_db()
-
+def monitor(notify):
     # 互換: SEED_LATEST=1 を見たら FORCE_SEED=1 と同義に
     if os.getenv("SEED_LATEST", "") == "1" and os.getenv("FORCE_SEED") is None:
         os.environ["FORCE_SEED"] = "1"
@@ -358,14 +872,14 @@ def main():
     auto_sample_first = os.getenv("AUTO_SAMPLE_FIRST", "1").lower() in ("1","true","yes")
     print(f"[DEBUG] AUTO_SAMPLE_FIRST={auto_sample_first}")
     if auto_sample_first:
-        for host, rule in SITE_RULES.items():
+        for host, rule in RULES.items():
             try:
                 if (not host_seeded(host)) and (not sample_sent(host)):
                     picked = pick_latest_matching(host, rule)
                     if picked:
                         src, d = picked
                         item_id = make_item_id(d["url"], d["updated"], d["published"], rule)
-                        save({"id": item_id, **d}, src)
+                        stage({"id": item_id, **d}, src)
                         subject = f"【初回サンプル（既存最新）】{d['title']}"
                         body = (
                             f"タイトル：{d['title']}\n"
@@ -374,15 +888,15 @@ def main():
                             f"出所：{src}\n"
                             f"※初回のみ、既存の最新ヒット1件を自動送信しています。"
                         )
-                        send_mail(subject, body)
+                        notify(subject, body)
                         mark_sample_sent(host)
-                        time.sleep(1)
             except Exception as e:
                 notify_error("【初回サンプル送信エラー】", f"HOST: {host}\nError: {e}")
+            flush_pending()
 
     # （任意）手動テスト送信（既存最新を各ホスト1件）—必要時だけ
     if os.getenv("FORCE_SAMPLE","0").lower() in ("1","true","yes"):
-        for host, rule in SITE_RULES.items():
+        for host, rule in RULES.items():
             if sample_sent(host):
                 print(f"[INFO] sample already sent for {host}")
                 continue
@@ -392,7 +906,7 @@ def main():
                 continue
             src, d = picked
             item_id = make_item_id(d["url"], d["updated"], d["published"], rule)
-            save({"id": item_id, **d}, src)
+            stage({"id": item_id, **d}, src)
             subject = f"【テスト送信（既存最新）】{d['title']}"
             body = (
                 f"タイトル：{d['title']}\n"
@@ -401,29 +915,37 @@ def main():
                 f"出所：{src}\n"
                 f"※これはテスト送信です（既存の中の最新1件）。今後は新着のみ通知します。"
             )
-            send_mail(subject, body)
+            notify(subject, body)
             mark_sample_sent(host)
-            time.sleep(1)
+            flush_pending()
 
     # 通常運転（新着のみ通知）
-    for host, rule in SITE_RULES.items():
-        is_seed = not host_seeded(host) and os.getenv("FORCE_SEED", "1") == "1"
-        if is_seed:
-            print(f"[INFO] First-time silent seed for {host} (register existing items WITHOUT emailing)")
-
-        for src in rule["list_urls"]:
+    # 取得・解析は全ホスト並列、判定・登録・通知はホスト順に逐次
+    crawled_ok = set()
+    with ThreadPoolExecutor(max_workers=len(RULES)) as ex:
+        crawls = {host: ex.submit(crawl, host, rule, "【監視失敗】サイト取得エラー", skip_known=True) for host, rule in RULES.items()}
+        for host, rule in RULES.items():
+            is_seed = not host_seeded(host) and os.getenv("FORCE_SEED", "1") == "1"
+            if is_seed:
+                print(f"[INFO] First-time silent seed for {host} (register existing items WITHOUT emailing)")
+
+            # 複数の一覧に載っている詳細URLも取得・解析は1回だけ
+            sources, details, log = crawls[host].result()
+            report(log)
+            # 一覧がすべて取れたホストだけ掃除する（詳細URLの失敗は FETCHED に入るので消されない）
+            if all(src in LIST_MEMO for src in rule.list_urls):
+                crawled_ok.add(host)
             try:
-                for url in pick_articles_from_list(src, rule):
-                    d = parse_detail(url, rule)
+                for d in details:
                     if not d["hit"]:
                         continue
+                    src = sources[d["url"]]
                     item_id = make_item_id(d["url"], d["updated"], d["published"], rule)
-                    if known(item_id) or (rule.get("brand_new_only", False) and known_by_url(d["url"])):
+                    if known(item_id) or (rule.brand_new_only and known_by_url(d["url"])):
                         continue
+                    stage({"id": item_id, **d}, src)
                     if is_seed:
-                        save({"id": item_id, **d}, src)
                         continue
-                    save({"id": item_id, **d}, src)
                     total_new += 1
                     subject = f"【新着】{d['title']}"
                     body = (
@@ -432,16 +954,29 @@ def main():
                         f"URL：{d['url']}\n"
                         f"出所：{src}\n"
                     )
-                    send_mail(subject, body)
-                    time.sleep(1)
-                time.sleep(2)
+                    notify(subject, body)
             except Exception as e:
-                notify_error("【監視失敗】サイト取得エラー", f"HOST: {host}\nSRC: {src}\nError: {e}")
+                notify_error("【監視失敗】サイト取得エラー", f"HOST: {host}\nError: {e}")
+            # ホスト単位で登録（途中で止まっても通知済みの分は残る）
+            flush_pending()
+
+    prune_caches(crawled_ok)
+    save_http_cache()
 
     if total_new == 0 and os.getenv("FORCE_MAIL","0") == "1":
-        send_mail("【監視テスト】通知経路の確認", "新着0件でしたが、通知経路の確認メールです。")
+        notify("【監視テスト】通知経路の確認", "新着0件でしたが、通知経路の確認メールです。")
 
     print(f"done. new={total_new}")
 
+def main():
+    print(f"[DEBUG] FORCE_MAIL={os.getenv('FORCE_MAIL')!r}  FORCE_SAMPLE={os.getenv('FORCE_SAMPLE')!r}  ERROR_NOTIFY={ERROR_NOTIFY}")
+    init_db()
+    with SMTPNotifier() as notify:
+        try:
+            monitor(notify)
+        finally:
+            # 途中で落ちても通知済みの分は必ず登録する
+            flush_pending()
+
 if __name__ == "__main__":
     main()